@@ -1,6 +1,9 @@
 """ Functions to test the DEM tools."""
 import os
+import threading
 import warnings
+from pathlib import Path
+from typing import Any
 
 import geoutils.georaster as gr
 import geoutils.satimg as si
@@ -16,6 +19,31 @@ from xdem.dem import DEM
 DO_PLOT = False
 
 
+def write_synthetic_geoid(filename: str, offset: float, slope_lat: float = 0) -> None:
+    """
+    Write a global geoid grid of 1 degree resolution, with geoid heights of offset + slope_lat * latitude.
+
+    :param filename: Filename of the grid
+    :param offset: Geoid height at the equator (m)
+    :param slope_lat: Variation of the geoid height with the latitude (m/degree)
+    """
+
+    lat = np.arange(90, -91, -1, dtype=np.float32)
+    geoid_heights = np.repeat((offset + slope_lat * lat)[:, np.newaxis], 361, axis=1)
+    with rio.open(
+        filename,
+        "w",
+        driver="GTiff",
+        height=181,
+        width=361,
+        count=1,
+        dtype="float32",
+        crs="EPSG:4979",
+        transform=rio.transform.from_origin(-180.5, 90.5, 1, 1),
+    ) as ds:
+        ds.write(geoid_heights, 1)
+
+
 class TestDEM:
     def test_init(self) -> None:
         """Test that inputs work properly in DEM class init."""
@@ -120,6 +148,54 @@ class TestDEM:
 
         assert np.array_equal(r3.data, r2.data)
 
+    def test_set_vref_attribute(self, tmp_path: Path) -> None:
+        """Test that directly assigning the vertical reference name or grid is taken into account"""
+
+        dem = xdem.DEM.from_array(
+            data=np.full((5, 5), 100, dtype=np.float32),
+            transform=rio.transform.from_bounds(500000, 8600000, 500100, 8600100, 5, 5),
+            crs=rio.crs.CRS.from_epsg(32633),
+            nodata=-9999,
+        )
+        assert dem.ccrs is None
+
+        # Assigning the name should update the compound CRS
+        dem.vref = "WGS84"
+        assert dem.ccrs == pyproj.CRS.from_epsg(32633)
+
+        # Same when assigning the grid
+        geoid_grid = str(tmp_path / "geoid.tif")
+        write_synthetic_geoid(geoid_grid, offset=10)
+        dem.vref = "Unknown vertical reference name from: " + geoid_grid
+        dem.vref_grid = geoid_grid
+        ccrs_geoid = dem.ccrs
+        assert ccrs_geoid.is_compound
+        dem.vref_grid = None
+        assert dem.ccrs is None
+
+        # And the conversion should start from the assigned vertical reference
+        dem.vref = "WGS84"
+        dem.to_vref(vref_grid=geoid_grid)
+        assert np.allclose(dem.data, 90)
+
+        # Assigning it back should convert from WGS84 again
+        dem.vref = "WGS84"
+        dem.vref_grid = None
+        dem.to_vref(vref_grid=geoid_grid)
+        assert np.allclose(dem.data, 80)
+
+    def test_parse_vref_from_product(self) -> None:
+        """Test that vertical references are parsed from product names"""
+
+        assert xdem.dem.parse_vref_from_product("TDM1") == "WGS84"
+        assert xdem.dem.parse_vref_from_product("NASADEM-HGTS") == "WGS84"
+        assert xdem.dem.parse_vref_from_product("SRTMGL1") == "EGM96"
+        assert xdem.dem.parse_vref_from_product("NASADEM-HGT") == "EGM96"
+        assert xdem.dem.parse_vref_from_product("COPDEM") == "EGM08"
+
+        # Unknown products have no vertical reference
+        assert xdem.dem.parse_vref_from_product("any product") is None
+
     def test_set_vref(self) -> None:
         """Tests to set the vertical reference"""
 
@@ -159,6 +235,247 @@ class TestDEM:
         with pytest.raises(ValueError):
             img.set_vref(vref_grid="the best grid in the entire world, or any non-existing string")
 
+    def test_ccrs(self) -> None:
+        """Test that the compound CRS is cached, and reset when the vertical reference changes"""
+
+        fn_img = xdem.examples.get_path("longyearbyen_ref_dem")
+        img = DEM(fn_img)
+
+        # Without vertical reference, there is no compound CRS
+        assert img.ccrs is None
+
+        # The compound CRS should be computed once, then re-used
+        img.set_vref(vref_name="WGS84")
+        ccrs_wgs84 = img.ccrs
+        assert isinstance(ccrs_wgs84, pyproj.CRS)
+        assert img.ccrs is ccrs_wgs84
+
+        # Changing the vertical reference should update the compound CRS
+        img.set_vref(vref_name="EGM96")
+        assert img.ccrs is not ccrs_wgs84
+        assert img.ccrs != ccrs_wgs84
+
+    def test_get_vertical_transformer(self) -> None:
+        """Test that vertical transformers are cached between identical references"""
+
+        xdem.dem._get_vertical_transformer.cache_clear()
+
+        wkt_4326 = pyproj.CRS.from_epsg(4326).to_wkt()
+        wkt_32633 = pyproj.CRS.from_epsg(32633).to_wkt()
+
+        # The same references should return the same transformer instance
+        transformer = xdem.dem._get_vertical_transformer(wkt_32633, None, None)
+        assert xdem.dem._get_vertical_transformer(wkt_32633, None, None) is transformer
+        assert xdem.dem._get_vertical_transformer.cache_info().hits == 1
+
+        # A different horizontal CRS should create a new transformer
+        assert xdem.dem._get_vertical_transformer(wkt_4326, None, None) is not transformer
+
+        # Without grids, the elevations should be unchanged
+        assert transformer.transform(500000, 8600000, 100)[2] == pytest.approx(100)
+
+        # Including for horizontal units other than metres
+        wkt_2263 = pyproj.CRS.from_epsg(2263).to_wkt()
+        transformer_feet = xdem.dem._get_vertical_transformer(wkt_2263, None, None)
+        assert transformer_feet.transform(1000010, 199990, 100)[2] == pytest.approx(100, abs=1e-3)
+
+    def test_to_vref_unchanged(self) -> None:
+        """Test that converting to the same vertical reference leaves the DEM unchanged"""
+
+        dem = xdem.DEM.from_array(
+            data=np.arange(25, dtype=np.float32).reshape(5, 5),
+            transform=rio.transform.from_bounds(500000, 8600000, 500100, 8600100, 5, 5),
+            crs=rio.crs.CRS.from_epsg(32633),
+            nodata=-9999,
+        )
+        data_init = dem.data.copy()
+
+        for vref_name in ["WGS84", "EGM96"]:
+            dem.set_vref(vref_name=vref_name)
+            dem.to_vref(vref_name=vref_name)
+            assert dem.vref == vref_name
+            assert np.array_equal(dem.data, data_init)
+
+    @pytest.mark.parametrize(  # type: ignore
+        "epsg, transform",
+        [
+            (32633, rio.transform.from_origin(500000, 8600100, 20, 20)),
+            (4326, rio.transform.from_origin(15, 78.2, 0.01, 0.01)),
+            # Horizontal units in US feet, elevations in metres
+            (2263, rio.transform.from_origin(1000000, 200000, 20, 20)),
+        ],
+    )
+    def test_to_vref_synthetic(self, tmp_path: Path, epsg: int, transform: rio.Affine) -> None:
+        """Test the sign and size of the vertical shifts with synthetic geoid grids of constant heights"""
+
+        geoid_grid_10 = str(tmp_path / "geoid_10.tif")
+        geoid_grid_25 = str(tmp_path / "geoid_25.tif")
+        write_synthetic_geoid(geoid_grid_10, offset=10)
+        write_synthetic_geoid(geoid_grid_25, offset=25)
+
+        dem = xdem.DEM.from_array(
+            data=np.full((5, 5), 100, dtype=np.float32),
+            transform=transform,
+            crs=rio.crs.CRS.from_epsg(epsg),
+            nodata=-9999,
+        )
+        dem.set_vref(vref_name="WGS84")
+
+        # From the ellipsoid to a geoid 10 m above it, elevations should decrease by 10 m
+        dem.to_vref(vref_grid=geoid_grid_10)
+        assert dem.vref_grid == geoid_grid_10
+        assert np.allclose(dem.data, 90)
+
+        # From this geoid to a geoid 15 m higher, elevations should decrease by 15 m
+        dem.to_vref(vref_grid=geoid_grid_25)
+        assert dem.vref_grid == geoid_grid_25
+        assert np.allclose(dem.data, 75)
+
+        # Back to the ellipsoid, elevations should increase by 25 m
+        dem.to_vref(vref_name="WGS84")
+        assert dem.vref == "WGS84"
+        assert dem.vref_grid is None
+        assert np.allclose(dem.data, 100)
+
+    def test_to_vref_from_product(self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+        """Test that a vertical reference parsed from the product name is converted from its geoid grid"""
+
+        # An SRTMv4.1 DEM, of which the EGM96 vertical reference is parsed from the product name, without grid
+        fn_srtm = str(tmp_path / "srtm_38_03.tif")
+        gr.Raster.from_array(
+            data=np.full((5, 5), 100, dtype=np.float32),
+            transform=rio.transform.from_origin(500000, 8600100, 20, 20),
+            crs=rio.crs.CRS.from_epsg(32633),
+            nodata=-9999,
+        ).save(fn_srtm)
+        dem = DEM(fn_srtm)
+        assert dem.vref == "EGM96"
+        assert dem.vref_grid is None
+
+        # The EGM96 grid might not be installed, so only record the grids passed to the transformer
+        grids: list[tuple[str | None, str | None]] = []
+        _get_vertical_transformer = xdem.dem._get_vertical_transformer
+
+        def get_vertical_transformer(
+            crs_wkt: str, vref_grid_init: str | None, vref_grid_dest: str | None
+        ) -> pyproj.Transformer:
+            grids.append((vref_grid_init, vref_grid_dest))
+            return _get_vertical_transformer(crs_wkt, None, None)
+
+        monkeypatch.setattr(xdem.dem, "_get_vertical_transformer", get_vertical_transformer)
+        dem.to_vref(vref_name="WGS84")
+
+        # The conversion should start from the EGM96 grid
+        assert grids == [("us_nga_egm96_15.tif", None)]
+        assert dem.vref == "WGS84"
+        assert dem.vref_grid is None
+
+    def test_to_vref_rows(self, tmp_path: Path) -> None:
+        """Test that each row of a north-up DEM is shifted by the geoid height at its own latitude"""
+
+        # Geoid heights equal to the latitude
+        geoid_grid = str(tmp_path / "geoid_lat.tif")
+        write_synthetic_geoid(geoid_grid, offset=0, slope_lat=1)
+
+        # North-up DEM from latitude 20 (top) to 10 (bottom)
+        dem = xdem.DEM.from_array(
+            data=np.full((10, 3), 100, dtype=np.float32),
+            transform=rio.transform.from_origin(15, 20, 1, 1),
+            crs=rio.crs.CRS.from_epsg(4326),
+            nodata=-9999,
+        )
+        dem.set_vref(vref_name="WGS84")
+        dem.to_vref(vref_grid=geoid_grid)
+
+        # The pixel centers of the top and bottom rows are at latitudes 19.5 and 10.5
+        assert np.allclose(dem.data[0, 0, :], 100 - 19.5)
+        assert np.allclose(dem.data[0, -1, :], 100 - 10.5)
+        assert np.allclose(dem.data[0, :, 0], 100 - np.arange(19.5, 10, -1))
+
+    def test_to_vref_blocks(self, tmp_path: Path) -> None:
+        """Test the conversion of a DEM large enough to be transformed in several blocks of rows, in parallel"""
+
+        # Geoid heights equal to the latitude, to have different shifts for each block
+        geoid_grid = str(tmp_path / "geoid_lat.tif")
+        write_synthetic_geoid(geoid_grid, offset=0, slope_lat=1)
+
+        # More than 2**20 pixels, with a height that is not a multiple of the number of rows per block (1048)
+        height, width = 2500, 1000
+        data = np.ma.masked_array(np.full((height, width), 100, dtype=np.float32), mask=False)
+        data.mask[0, 0] = True
+        data.mask[-1, 500:] = True
+        dem = xdem.DEM.from_array(
+            data=data,
+            transform=rio.transform.from_origin(15, 70, 0.001, 0.001),
+            crs=rio.crs.CRS.from_epsg(4326),
+            nodata=-9999,
+        )
+        mask_init = np.ma.getmaskarray(dem.data).copy()
+        assert np.count_nonzero(mask_init) == 501
+        dem.set_vref(vref_name="WGS84")
+
+        # Convert with the default number of threads, and with a single thread
+        dem_single_thread = dem.copy()
+        dem.to_vref(vref_grid=geoid_grid)
+        dem_single_thread.to_vref(vref_grid=geoid_grid, n_threads=1)
+
+        # The results should be identical
+        assert np.array_equal(np.ma.getdata(dem.data), np.ma.getdata(dem_single_thread.data))
+
+        lat = 70 - (np.arange(height) + 0.5) * 0.001
+        for converted_dem in [dem, dem_single_thread]:
+            # The data type and the mask should be unchanged
+            assert converted_dem.data.dtype == np.float32
+            assert np.array_equal(np.ma.getmaskarray(converted_dem.data), mask_init)
+
+            # Each row should be shifted by the latitude of its pixel centers
+            assert np.allclose(np.ma.getdata(converted_dem.data)[0], 100 - lat[:, np.newaxis], atol=1e-4)
+
+    def test_to_vref_transformer_reuse(self, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+        """Test that repeated conversions do not re-instantiate the PROJ transformers in each thread"""
+
+        geoid_grid_10 = str(tmp_path / "geoid_10.tif")
+        geoid_grid_25 = str(tmp_path / "geoid_25.tif")
+        write_synthetic_geoid(geoid_grid_10, offset=10)
+        write_synthetic_geoid(geoid_grid_25, offset=25)
+
+        # Record the pipeline and thread of each instantiation of a PROJ transformer, done by pyproj in each thread
+        builds = []
+        transformer_maker = pyproj.transformer.TransformerFromPipeline.__call__
+
+        def record_build(self: pyproj.transformer.TransformerFromPipeline) -> Any:
+            builds.append((self.proj_pipeline, threading.current_thread().name))
+            return transformer_maker(self)
+
+        monkeypatch.setattr(pyproj.transformer.TransformerFromPipeline, "__call__", record_build)
+
+        # Two blocks of one row
+        data = np.ma.masked_array(np.full((2, 2**20), 100, dtype=np.float32), mask=False)
+        dem = xdem.DEM.from_array(
+            data=data,
+            transform=rio.transform.from_origin(15, 70, 0.00001, 0.00001),
+            crs=rio.crs.CRS.from_epsg(4326),
+            nodata=-9999,
+        )
+        dem.set_vref(vref_grid=geoid_grid_10)
+
+        for n_threads in [1, 2]:
+            xdem.dem._get_vertical_transformer.cache_clear()
+            builds.clear()
+            # Convert back and forth between the two grids
+            for _ in range(8):
+                dem.to_vref(vref_grid=geoid_grid_25, n_threads=n_threads)
+                dem.to_vref(vref_grid=geoid_grid_10, n_threads=n_threads)
+            assert np.allclose(np.ma.getdata(dem.data), 100)
+
+            if n_threads == 1:
+                # The blocks are transformed in the calling thread, so each transformer is only instantiated once
+                assert len(builds) == 2
+            else:
+                # Each transformer is instantiated at most once per thread, as the threads persist between conversions
+                assert len(builds) == len(set(builds))
+                assert len(builds) < 16
+
     @pytest.mark.skip("This fails on Windows because the grids are not found")  # type: ignore
     def test_to_vref(self) -> None:
         """Tests to convert vertical references"""
@@ -1,12 +1,15 @@
 """DEM class and functions."""
 from __future__ import annotations
 
-import json
+import concurrent.futures
+import enum
+import functools
 import os
-import subprocess
+import threading
 import warnings
 from typing import Any
 
+import numpy as np
 import pyproj
 import rasterio as rio
 from geoutils.georaster.raster import RasterType
@@ -16,6 +19,106 @@ from pyproj import Transformer
 from xdem._typing import NDArrayf
 
 
+# Metadata parsing from file is not implemented in SatelliteImage, the warning is not relevant when loading DEMs
+warnings.filterwarnings("ignore", message="Parse metadata from file not implemented")
+
+
+@functools.lru_cache(maxsize=256)
+def _get_geoid_ccrs(epsg: int, vref_grid: str) -> pyproj.CRS:
+    """
+    Get the compound CRS of a horizontal EPSG CRS with a geoid grid, cached to build it only once per pair.
+
+    :param epsg: EPSG code of the horizontal CRS
+    :param vref_grid: Vertical reference grid (any grid file in https://github.com/OSGeo/PROJ-data)
+
+    :return: ccrs: Compound CRS
+    """
+
+    # Add geoid grid to the PROJ string of the horizontal CRS (instead of the deprecated init= syntax),
+    # see https://gis.stackexchange.com/questions/352277/
+    horizontal_crs = pyproj.CRS.from_epsg(epsg)
+    with warnings.catch_warnings():
+        # Converting to a PROJ string is lossy in general, but not for the EPSG horizontal CRSs used here
+        warnings.filterwarnings("ignore", message="You will likely lose important projection information")
+        return pyproj.CRS.from_proj4(horizontal_crs.to_proj4() + " +geoidgrids=" + vref_grid + " +vunits=m")
+
+
+@functools.lru_cache(maxsize=256)
+def _get_vertical_transformer(crs_wkt: str, vref_grid_init: str | None, vref_grid_dest: str | None) -> Transformer:
+    """
+    Get a transformer applying only the vertical shift between two vertical references of the same horizontal CRS,
+    cached to avoid re-instantiating it for each conversion.
+
+    The horizontal CRS is passed as a WKT string, as pyproj.CRS objects are not hashable in all versions.
+    The cache can be freed with `_get_vertical_transformer.cache_clear()`.
+
+    :param crs_wkt: WKT string of the horizontal CRS
+    :param vref_grid_init: Initial vertical reference grid, None for the WGS84 ellipsoid
+    :param vref_grid_dest: Destination vertical reference grid, None for the WGS84 ellipsoid
+
+    :return: transformer: Transformer of which only the output elevations are relevant
+    """
+
+    horizontal_crs = pyproj.CRS.from_wkt(crs_wkt)
+    with warnings.catch_warnings():
+        # Converting to a PROJ string is lossy in general, but only the projection is used here
+        warnings.filterwarnings("ignore", message="You will likely lose important projection information")
+        horizontal_proj4 = horizontal_crs.to_proj4().replace(" +type=crs", "")
+
+    # Convert to geographic coordinates, in which the grids are defined. The projection back to the horizontal CRS
+    # is skipped, as the horizontal coordinates are unchanged. The vertical units are set to metres, otherwise
+    # the inverse projection would convert elevations from the horizontal units (e.g., feet) to metres
+    pipeline = "+proj=pipeline +step +inv " + horizontal_proj4 + " +vunits=m"
+    # Then, shift from the initial geoid to the ellipsoid, and from the ellipsoid to the destination geoid
+    if vref_grid_init is not None:
+        pipeline += " +step +proj=vgridshift +grids=" + vref_grid_init + " +multiplier=1"
+    if vref_grid_dest is not None:
+        pipeline += " +step +proj=vgridshift +grids=" + vref_grid_dest + " +multiplier=-1"
+
+    return Transformer.from_pipeline(pipeline)
+
+
+# Default maximum amount of threads of a ThreadPoolExecutor
+_MAX_THREADS = min(32, (os.cpu_count() or 1) + 4)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Get the thread pool shared by all vertical conversions, created once on first use.
+
+    The worker threads persist between conversions: pyproj instantiates a transformer separately in each thread
+    that uses it, so re-using the same threads avoids re-instantiating the cached transformers for each conversion.
+
+    :return: executor: Thread pool executor
+    """
+
+    return concurrent.futures.ThreadPoolExecutor(max_workers=_MAX_THREADS, thread_name_prefix="xdem_to_vref")
+
+
+# Sources for defining vertical references:
+# AW3D30: https://www.eorc.jaxa.jp/ALOS/en/aw3d30/aw3d30v11_format_e.pdf
+# SRTMGL1: https://lpdaac.usgs.gov/documents/179/SRTM_User_Guide_V3.pdf
+# SRTMv4.1: http://www.cgiar-csi.org/data/srtm-90m-digital-elevation-database-v4-1
+# ASTGTM2/ASTGTM3: https://lpdaac.usgs.gov/documents/434/ASTGTM_User_Guide_V3.pdf
+# NASADEM: https://lpdaac.usgs.gov/documents/592/NASADEM_User_Guide_V1.pdf, HGTS is ellipsoid, HGT is EGM96 geoid !!
+# ArcticDEM (mosaic and strips): https://www.pgc.umn.edu/data/arcticdem/
+# REMA (mosaic and strips): https://www.pgc.umn.edu/data/rema/
+# TanDEM-X 90m global: https://geoservice.dlr.de/web/dataguide/tdm90/
+# COPERNICUS DEM: https://spacedata.copernicus.eu/web/cscda/dataset-details?articleId=394198
+_VREF_BY_PRODUCT = {
+    "ArcticDEM/REMA": "WGS84",
+    "TDM1": "WGS84",
+    "NASADEM-HGTS": "WGS84",
+    "AW3D30": "EGM96",
+    "SRTMv4.1": "EGM96",
+    "SRTMGL1": "EGM96",
+    "ASTGTM2": "EGM96",
+    "NASADEM-HGT": "EGM96",
+    "COPDEM": "EGM08",
+}
+
+
 def parse_vref_from_product(product: str) -> str | None:
     """
 
@@ -23,30 +126,41 @@ def parse_vref_from_product(product: str) -> str | None:
 
     :return: vref_name: Vertical reference name
     """
-    # Sources for defining vertical references:
-    # AW3D30: https://www.eorc.jaxa.jp/ALOS/en/aw3d30/aw3d30v11_format_e.pdf
-    # SRTMGL1: https://lpdaac.usgs.gov/documents/179/SRTM_User_Guide_V3.pdf
-    # SRTMv4.1: http://www.cgiar-csi.org/data/srtm-90m-digital-elevation-database-v4-1
-    # ASTGTM2/ASTGTM3: https://lpdaac.usgs.gov/documents/434/ASTGTM_User_Guide_V3.pdf
-    # NASADEM: https://lpdaac.usgs.gov/documents/592/NASADEM_User_Guide_V1.pdf, HGTS is ellipsoid, HGT is EGM96 geoid !!
-    # ArcticDEM (mosaic and strips): https://www.pgc.umn.edu/data/arcticdem/
-    # REMA (mosaic and strips): https://www.pgc.umn.edu/data/rema/
-    # TanDEM-X 90m global: https://geoservice.dlr.de/web/dataguide/tdm90/
-    # COPERNICUS DEM: https://spacedata.copernicus.eu/web/cscda/dataset-details?articleId=394198
-
-    if product in ["ArcticDEM/REMA", "TDM1", "NASADEM-HGTS"]:
-        vref_name = "WGS84"
-    elif product in ["AW3D30", "SRTMv4.1", "SRTMGL1", "ASTGTM2", "NASADEM-HGT"]:
-        vref_name = "EGM96"
-    elif product in ["COPDEM"]:
-        vref_name = "EGM08"
-    else:
-        vref_name = None
 
-    return vref_name
+    return _VREF_BY_PRODUCT.get(product)
 
 
-dem_attrs = ["vref", "vref_grid", "_ccrs"]
+class _VRef(enum.IntEnum):
+    """
+    Kind of vertical reference, stored to avoid comparing vertical reference names.
+
+    Only the kinds that are handled differently are distinguished: no vertical reference, the WGS84 ellipsoid, or a
+    geoid (any other vertical reference, defined by a grid).
+    """
+
+    NONE = 0
+    WGS84 = 1
+    GEOID = 2
+
+
+def _get_vref_kind(vref_name: str | None) -> _VRef:
+    """
+    Get the kind of a vertical reference from its name.
+
+    :param vref_name: Vertical reference name
+
+    :return: vref_kind: Kind of vertical reference
+    """
+
+    if vref_name is None:
+        return _VRef.NONE
+    elif vref_name == "WGS84":
+        return _VRef.WGS84
+    else:
+        return _VRef.GEOID
+
+
+dem_attrs = ["vref", "vref_grid", "_ccrs", "_vref_kind"]
 
 
 class DEM(SatelliteImage):  # type: ignore
@@ -74,14 +188,11 @@ class DEM(SatelliteImage):  # type: ignore
 
         # If DEM is passed, simply point back to DEM
         if isinstance(filename_or_dataset, DEM):
-            for key in filename_or_dataset.__dict__:
-                setattr(self, key, filename_or_dataset.__dict__[key])
+            self.__dict__.update(filename_or_dataset.__dict__)
             return
         # Else rely on parent SatelliteImage class options (including raised errors)
         else:
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore", message="Parse metadata from file not implemented")
-                super().__init__(filename_or_dataset, silent=silent, **kwargs)
+            super().__init__(filename_or_dataset, silent=silent, **kwargs)
 
         # self.indexes can be None when data is not loaded through the Raster class
         if self.indexes is not None and len(self.indexes) > 1:
@@ -99,22 +210,49 @@ class DEM(SatelliteImage):  # type: ignore
 
         new_dem = super().copy(new_array=new_array)  # type: ignore
         # The rest of attributes are immutable, including pyproj.CRS
-        # dem_attrs = ['vref','vref_grid','ccrs'] #taken outside of class
-        for attrs in dem_attrs:
-            setattr(new_dem, attrs, getattr(self, attrs))
+        # The backing attributes are assigned directly rather than looping on dem_attrs, which lists the vref and
+        # vref_grid properties: their setters would reset the compound CRS already derived for this DEM
+        new_dem._vref = self._vref
+        new_dem._vref_grid = self._vref_grid
+        new_dem._vref_kind = self._vref_kind
+        new_dem._ccrs = self._ccrs
 
         return new_dem  # type: ignore
 
+    @property
+    def vref(self) -> str | None:
+        """Vertical reference name"""
+        return self._vref
+
+    @vref.setter
+    def vref(self, vref_name: str | None) -> None:
+        """Set the vertical reference name, and reset the attributes that depend on it."""
+        self._vref = vref_name
+        self._vref_kind = _get_vref_kind(vref_name)
+        # The compound CRS depends on the vertical reference
+        self._ccrs = None
+
+    @property
+    def vref_grid(self) -> str | None:
+        """Vertical reference grid"""
+        return self._vref_grid
+
+    @vref_grid.setter
+    def vref_grid(self, vref_grid: str | None) -> None:
+        """Set the vertical reference grid, and reset the compound CRS that depends on it."""
+        self._vref_grid = vref_grid
+        self._ccrs = None
+
     def __parse_vref_from_fn(self, silent: bool = False) -> None:
         """Attempts to pull vertical reference from product name identified by SatImg."""
 
         if self.product is not None:
             vref = parse_vref_from_product(self.product)
-            if vref is not None and self.vref is None:
+            if vref is not None and self._vref_kind is _VRef.NONE:
                 if not silent:
                     print('From product name "' + str(self.product) + '": setting vertical reference as ' + str(vref))
                 self.vref = vref
-            elif vref is not None and self.vref is not None:
+            elif vref is not None:
                 if not silent:
                     print(
                         "Leaving user input of "
@@ -131,33 +269,22 @@ class DEM(SatelliteImage):  # type: ignore
     def ccrs(self) -> pyproj.CRS:
         """Set compound CRS, i.e. horizontal and vertical references"""
 
-        # Temporary fix for some CRS with proj < 7.2
-        def get_crs(filepath: str) -> pyproj.CRS:
-            """Get the CRS of a raster with the given filepath."""
-            info = subprocess.run(
-                ["gdalinfo", "-json", filepath], stdout=subprocess.PIPE, check=True, encoding="utf-8"
-            ).stdout
-
-            wkt_string = json.loads(info)["coordinateSystem"]["wkt"]
+        # The compound CRS only changes with the vertical reference, and is reset when setting it
+        if self._ccrs is not None:
+            return self._ccrs
 
-            return pyproj.CRS.from_wkt(wkt_string)
-
-        # Temporary fix to get all types of CRS
+        # Temporary fix to get all types of CRS with proj < 7.2: read the WKT of the already-opened dataset
         if pyproj.proj_version_str >= "7.2.0":
             crs = self.crs
         else:
-            crs = get_crs(self.filename)
+            crs = pyproj.CRS.from_wkt(self.crs.wkt)
 
-        if self.vref == "WGS84":
+        if self._vref_kind is _VRef.WGS84:
             # The WGS84 ellipsoid corresponds to no vertical reference in pyproj
             self._ccrs = pyproj.CRS(crs)
         elif self.vref_grid is not None:
-            # For other vrefs, keep same horizontal projection and add geoid grid (the "dirty" way: because init is so
-            # practical and still going to be used for a while)
-            # see https://gis.stackexchange.com/questions/352277/
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore", module="pyproj")
-                self._ccrs = pyproj.Proj(init="EPSG:" + str(int(crs.to_epsg())), geoidgrids=self.vref_grid).crs
+            # For other vrefs, keep same horizontal projection and add geoid grid
+            self._ccrs = _get_geoid_ccrs(int(crs.to_epsg()), self.vref_grid)
         else:
             self._ccrs = None
 
@@ -218,38 +345,88 @@ class DEM(SatelliteImage):  # type: ignore
         else:
             raise ValueError("Vertical reference name or vertical grid must be a string")
 
-    def to_vref(self, vref_name: str = "EGM96", vref_grid: str | None = None) -> None:
+    def to_vref(self, vref_name: str = "EGM96", vref_grid: str | None = None, n_threads: int | None = None) -> None:
 
         """
         Convert between vertical references: ellipsoidal heights or geoid grids.
 
+        The geoid grids are read by PROJ from the pyproj data directory. These are tiled GeoTIFF grids of which
+        PROJ caches the blocks in memory, so that they are not read from disk for each pixel. If a grid is missing
+        locally and PROJ network access is enabled, it is fetched remotely: set the environment variable
+        PROJ_NETWORK=OFF to ensure only local grids are used.
+
         :param vref_name: Vertical reference name
         :param vref_grid: Vertical reference grid (any grid file in https://github.com/OSGeo/PROJ-data)
+        :param n_threads: The maximum amount of threads to use. Default=auto
 
         :return:
         """
 
         # All transformations grids file are described here: https://github.com/OSGeo/PROJ-data
-        if self.vref is None and self.vref_grid is None:
+        if self._vref_kind is _VRef.NONE and self.vref_grid is None:
             raise ValueError(
                 "The current DEM has not vertical reference: need to set one before attempting a conversion "
                 "towards another vertical reference."
             )
 
-        # Initial ccrs
-        ccrs_init = self.ccrs
+        # If the vertical reference was set without grid (from the product name or at instantiation), get the grid
+        if self._vref_kind is not _VRef.WGS84 and self.vref_grid is None:
+            self.set_vref(vref_name=self.vref)
 
-        # Destination crs: first, set the new reference (before calculation doesn't change anything,
+        # Initial vref
+        vref_init = (self.vref, self.vref_grid)
+
+        # Destination vref: first, set the new reference (before calculation doesn't change anything,
         # we need to update the data manually anyway)
         self.set_vref(vref_name=vref_name, vref_grid=vref_grid)
-        ccrs_dest = self.ccrs
 
-        # Transform the grid
-        transformer = Transformer.from_crs(ccrs_init, ccrs_dest)
+        # If the vertical reference is unchanged, there is nothing to convert
+        if (self.vref, self.vref_grid) == vref_init:
+            return
+
+        # The horizontal CRS is unchanged, so only the vertical shift between the two grids is computed
+        transformer = _get_vertical_transformer(self.crs.to_wkt(), vref_init[1], self.vref_grid)
+
+        # Transform the grid by blocks of rows, using float64 buffers re-used for each block that pyproj modifies in
+        # place, to avoid allocating float64 copies of the full DEM
         zz = self.data
-        xx, yy = self.coords(offset="center")
-        zz_trans = transformer.transform(xx, yy, zz[0, :])[2]
-        zz[0, :] = zz_trans
+        # Write in the unmasked data to preserve the mask
+        zz_data = np.ma.getdata(zz)[0]
+        height, width = zz_data.shape
+        # Pixel center coordinates are separable, so only 1-D vectors are derived from the transform, and broadcast
+        # to each block
+        xs = self.transform.c + (np.arange(width) + 0.5) * self.transform.a
+        ys = self.transform.f + (np.arange(height) + 0.5) * self.transform.e
+        rows_per_block = max(1, 2**20 // width)
+        # The buffers are local to each thread
+        thread_buffers = threading.local()
+
+        def transform_blocks(row_starts: range) -> None:
+            """Transform the elevations of the blocks of rows starting at the given rows."""
+            if not hasattr(thread_buffers, "xyz"):
+                thread_buffers.xyz = np.empty((3, min(height, rows_per_block) * width), dtype=np.float64)
+            xb, yb, zb = thread_buffers.xyz
+
+            for row_start in row_starts:
+                rows = slice(row_start, min(row_start + rows_per_block, height))
+                nb_pixels = (rows.stop - rows.start) * width
+                np.copyto(xb[:nb_pixels].reshape(-1, width), xs)
+                np.copyto(yb[:nb_pixels].reshape(-1, width), ys[rows, np.newaxis])
+                np.copyto(zb[:nb_pixels].reshape(-1, width), zz_data[rows])
+                transformer.transform(xb[:nb_pixels], yb[:nb_pixels], zb[:nb_pixels], inplace=True)
+                # The assignment casts back to the data type of the DEM
+                zz_data[rows] = zb[:nb_pixels].reshape(-1, width)
+
+        # The blocks are independent and pyproj releases the GIL during the transformation, so they are split in
+        # as many groups as threads, run in parallel sharing the same (thread-safe) transformer
+        block_starts = range(0, height, rows_per_block)
+        nb_groups = min(n_threads or _MAX_THREADS, len(block_starts))
+        if nb_groups == 1:
+            # Avoid the overhead of a thread for a single group, and use the transformer of the calling thread
+            transform_blocks(block_starts)
+        else:
+            # Consume the results to raise any exception
+            list(_get_executor().map(transform_blocks, [block_starts[i::nb_groups] for i in range(nb_groups)]))
 
         # Update raster
         self.data = zz